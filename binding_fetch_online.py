@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import argparse, json, re, sys, time, math
 from pathlib import Path
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 import pandas as pd
 import numpy as np
 
@@ -31,45 +31,90 @@ def extract_protein_name_from_header(h:str)->Optional[str]:
         if len(parts)>=3: return parts[2].split()[0]
     return h.split()[0] if h else None
 
-def http_get_json(url, params=None, timeout=20):
-    import requests, time
+class Deadline:
+    """Wall-clock budget; a child budget never outlives its parent."""
+    def __init__(self, seconds:Optional[float]=None, parent:'Optional[Deadline]'=None):
+        self.end=time.monotonic()+seconds if seconds is not None else None
+        self.parent=parent
+        self.hit=False  # set once any call was cut short by this budget
+    def remaining(self)->float:
+        r=float('inf') if self.end is None else self.end-time.monotonic()
+        if self.parent is not None: r=min(r, self.parent.remaining())
+        return r
+    def expired(self)->bool:
+        if self.remaining()<=0:
+            self.hit=True
+            return True
+        return False
+    def cap(self, timeout:float)->float:
+        return max(0.1, min(timeout, self.remaining()))
+    def timeouts(self, timeout:float, connect:float=10.0)->Tuple[float,float]:
+        """(connect, read) timeouts for requests, both capped to the remaining budget."""
+        return self.cap(min(connect, timeout)), self.cap(timeout)
+
+def get_within(url, params=None, timeout=20, deadline:Optional[Deadline]=None):
+    """requests.get whose body download also honours `deadline`.
+
+    Returns (response, body bytes, complete). The body is streamed and the
+    deadline is checked between chunks, so a slowly trickling page is cut off
+    with complete=False and whatever arrived so far.
+    """
+    import requests
+    headers={'User-Agent':'DTA-OnlineFetcher/1.0'}
+    if not deadline:
+        r=requests.get(url, params=params, timeout=timeout, headers=headers)
+        return r, r.content, True
+    r=requests.get(url, params=params, timeout=deadline.timeouts(timeout), headers=headers, stream=True)
+    chunks=[]
+    with r:
+        for c in r.iter_content(chunk_size=65536):
+            chunks.append(c)
+            if deadline.expired(): return r, b''.join(chunks), False
+    return r, b''.join(chunks), True
+
+def http_get_json(url, params=None, timeout=20, deadline:Optional[Deadline]=None):
+    import time
     for _ in range(3):
+        if deadline and deadline.expired(): return None
         try:
-            r=requests.get(url, params=params, timeout=timeout, headers={'User-Agent':'DTA-OnlineFetcher/1.0'})
-            if r.ok: return r.json()
+            r, body, complete=get_within(url, params=params, timeout=timeout, deadline=deadline)
+            if not complete: return None
+            if r.ok: return json.loads(body)
         except Exception:
             pass
-        time.sleep(1.2)
+        if deadline and deadline.expired(): return None
+        time.sleep(max(0.0, min(1.2, deadline.remaining())) if deadline else 1.2)
     return None
 
-def resolve_pubchem_by_name(name:str)->Dict[str,Optional[str]]:
+def resolve_pubchem_by_name(name:str, deadline:Optional[Deadline]=None)->Dict[str,Optional[str]]:
     import requests
     out={}
     try:
         url=f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{requests.utils.quote(name)}/property/IsomericSMILES,InChIKey/JSON"
-        data=http_get_json(url)
+        data=http_get_json(url, deadline=deadline)
         if data and 'PropertyTable' in data:
             props=data['PropertyTable']['Properties'][0]
             out['smiles']=props.get('IsomericSMILES'); out['inchikey']=props.get('InChIKey')
         url2=f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{requests.utils.quote(name)}/cids/JSON"
-        data2=http_get_json(url2)
+        data2=http_get_json(url2, deadline=deadline)
         if data2 and 'IdentifierList' in data2 and data2['IdentifierList'].get('CID'):
             out['cid']=str(data2['IdentifierList']['CID'][0])
     except Exception: pass
     return out
 
-def resolve_pubchem_by_smiles(smiles:str)->Dict[str,Optional[str]]:
+def resolve_pubchem_by_smiles(smiles:str, deadline:Optional[Deadline]=None)->Dict[str,Optional[str]]:
     out={'smiles':smiles}
     try:
         import requests as rq
         url="https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/smiles/property/IsomericSMILES,InChIKey/JSON"
-        data=http_get_json(url, params={'smiles':smiles})
+        data=http_get_json(url, params={'smiles':smiles}, deadline=deadline)
         if data and 'PropertyTable' in data:
             props=data['PropertyTable']['Properties'][0]
             out['smiles']=props.get('IsomericSMILES', smiles)
             out['inchikey']=props.get('InChIKey')
         url2="https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/smiles/cids/JSON"
-        r=rq.post(url2, data={'smiles':smiles}, timeout=20)
+        if deadline and deadline.expired(): return out
+        r=rq.post(url2, data={'smiles':smiles}, timeout=deadline.timeouts(20) if deadline else 20)
         if r.ok:
             d=r.json()
             if 'IdentifierList' in d and d['IdentifierList'].get('CID'):
@@ -77,8 +122,8 @@ def resolve_pubchem_by_smiles(smiles:str)->Dict[str,Optional[str]]:
     except Exception: pass
     return out
 
-def pubchem_assay_summary(cid:str)->pd.DataFrame:
-    data=http_get_json(f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/assaysummary/JSON")
+def pubchem_assay_summary(cid:str, deadline:Optional[Deadline]=None)->pd.DataFrame:
+    data=http_get_json(f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/assaysummary/JSON", deadline=deadline)
     rows=[]
     try:
         for a in data.get('AssaySummaries',{}).get('AssaySummary',[]):
@@ -89,60 +134,166 @@ def pubchem_assay_summary(cid:str)->pd.DataFrame:
     except Exception: pass
     return pd.DataFrame(rows)
 
-def chembl_targets_by_uniprot(uniprot:str)->List[str]:
+def chembl_targets_by_uniprot(uniprot:str, deadline:Optional[Deadline]=None)->List[str]:
     base="https://www.ebi.ac.uk/chembl/api/data/target.json"
-    data=http_get_json(base, params={'target_components__accession':uniprot,'limit':1000})
+    data=http_get_json(base, params={'target_components__accession':uniprot,'limit':1000}, deadline=deadline)
     return [t.get('target_chembl_id') for t in (data or {}).get('targets',[]) if t.get('target_chembl_id')]
 
-def chembl_molecule_ids_by_name(name:str)->List[str]:
-    base="https://www.ebi.ac.uk/chembl/api/data/molecule.json"
-    ids=set()
-    d=http_get_json(base, params={'molecule_synonyms__icontains':name,'limit':100})
-    for m in (d or {}).get('molecules',[]): 
-        mid=m.get('molecule_chembl_id'); 
-        if mid: ids.add(mid)
-    d2=http_get_json(base, params={'pref_name__iexact':name,'limit':50})
-    for m in (d2 or {}).get('molecules',[]): 
-        mid=m.get('molecule_chembl_id'); 
-        if mid: ids.add(mid)
-    return list(ids)
-
-def chembl_activities(target_ids:List[str], molecule_ids:List[str])->pd.DataFrame:
-    import requests
+def _chembl_molecules(params, deadline:Optional[Deadline]=None, limit=100)->Optional[List[dict]]:
+    """Molecule records matching `params`; None if the request failed (network/deadline)."""
+    d=http_get_json("https://www.ebi.ac.uk/chembl/api/data/molecule.json", params={**params,'limit':limit}, deadline=deadline)
+    if d is None: return None
+    return [m for m in d.get('molecules',[]) if m.get('molecule_chembl_id')]
+
+def _parent_id(m:dict)->str:
+    return (m.get('molecule_hierarchy') or {}).get('parent_chembl_id') or m['molecule_chembl_id']
+
+CHEMBL_CACHE_NAME='chembl_inchikey_cache.json'
+_CHEMBL_BY_INCHIKEY: Dict[str,Tuple[List[str],List[str]]]={}
+
+def load_chembl_cache(path:Optional[Path]):
+    if not path: return
+    for k,v in _read_chembl_cache(Path(path)).items():
+        _CHEMBL_BY_INCHIKEY.setdefault(k, (v['ids'], v['parents']))
+
+def _read_chembl_cache(path:Path)->dict:
+    try: return json.loads(path.read_text(encoding='utf-8')) if path.exists() else {}
+    except Exception as e:
+        eprint(f'[WARN] ignoring unreadable ChEMBL cache {path}: {e}')
+        return {}
+
+def save_chembl_cache(path:Optional[Path], drop=()):
+    """Merge this process's lookups into the JSON file (entries written by other runs are kept)."""
+    if not path: return
+    path=Path(path)
+    data=_read_chembl_cache(path)
+    # "no match" stays in-process only: a molecule missing from one ChEMBL release may appear in the next
+    data.update({k:{'ids':ids,'parents':parents} for k,(ids,parents) in _CHEMBL_BY_INCHIKEY.items() if ids})
+    for k in drop: data.pop(k, None)
+    tmp=path.with_name(path.name+'.tmp')
+    tmp.write_text(json.dumps(dict(sorted(data.items())), indent=1), encoding='utf-8')
+    tmp.replace(path)
+
+def chembl_molecule_ids_by_inchikey(inchikey:str, deadline:Optional[Deadline]=None,
+                                    cache_path:Optional[Path]=None, refresh:bool=False)->Tuple[List[str],List[str]]:
+    """Exact ChEMBL lookup on standard InChIKey, widened to salts/parents via the molecule hierarchy.
+
+    Falls back to the connectivity layer (first InChIKey block) when the full key
+    has no match. Returns (molecule ids to fetch, parent ids of the query compound);
+    connectivity-only matches are not counted as the query compound.
+    Memoized per InChIKey in `cache_path` (JSON) so separate runs share lookups;
+    results of failed or deadline-cut requests are not cached and empty results
+    are not written to disk. `refresh` ignores any cached entry and re-queries.
+    """
+    ik=(inchikey or '').strip().upper()
+    if not ik: return [], []
+    if not refresh:
+        if ik not in _CHEMBL_BY_INCHIKEY: load_chembl_cache(cache_path)
+        if ik in _CHEMBL_BY_INCHIKEY: return _CHEMBL_BY_INCHIKEY[ik]
+    complete=True
+    mols=_chembl_molecules({'molecule_structures__standard_inchi_key':ik}, deadline)
+    if mols is None: complete=False; mols=[]
+    query=sorted({_parent_id(m) for m in mols})
+    if not mols and complete:
+        mols=_chembl_molecules({'molecule_structures__standard_inchi_key__startswith':ik.split('-')[0]}, deadline)
+        if mols is None: complete=False; mols=[]
+    ids={m['molecule_chembl_id'] for m in mols}
+    parents={_parent_id(m) for m in mols}
+    ids|=parents
+    if parents:
+        kids=_chembl_molecules({'molecule_hierarchy__parent_chembl_id__in':','.join(sorted(parents))}, deadline, limit=1000)
+        if kids is None: complete=False; kids=[]
+        ids|={m['molecule_chembl_id'] for m in kids}
+    out=(sorted(ids), query)
+    if complete and not (deadline and deadline.hit):
+        _CHEMBL_BY_INCHIKEY[ik]=out
+        try: save_chembl_cache(cache_path, drop=() if out[0] else (ik,))
+        except OSError as e: eprint(f'[WARN] could not write ChEMBL cache {cache_path}: {e}')
+    return out
+
+def chembl_molecule_ids_by_name(name:str, deadline:Optional[Deadline]=None)->Tuple[List[str],List[str]]:
+    """Returns (molecule ids, parent ids of exact name/synonym matches)."""
+    mols=(_chembl_molecules({'pref_name__iexact':name}, deadline, limit=50) or [])
+    mols+=(_chembl_molecules({'molecule_synonyms__molecule_synonym__iexact':name}, deadline) or [])
+    query=sorted({_parent_id(m) for m in mols})
+    if not mols:
+        # substring synonym scan is slow and over-matches; last resort only
+        mols=_chembl_molecules({'molecule_synonyms__icontains':name}, deadline) or []
+    return sorted({m['molecule_chembl_id'] for m in mols}), query
+
+CHEMBL_ID_CHUNK=50  # ids per *_chembl_id__in filter, keeps GET URLs short
+
+def chembl_documents(doc_ids:List[str], deadline:Optional[Deadline]=None)->Dict[str,dict]:
+    """document_chembl_id -> {'PMID','DOI','Journal','Year'}; activities only carry the document id."""
+    ordered=sorted({d for d in doc_ids if d})
+    out={}
+    for i in range(0, len(ordered), CHEMBL_ID_CHUNK):
+        chunk=ordered[i:i+CHEMBL_ID_CHUNK]
+        d=http_get_json("https://www.ebi.ac.uk/chembl/api/data/document.json",
+                        params={'document_chembl_id__in':','.join(chunk),'limit':CHEMBL_ID_CHUNK}, deadline=deadline)
+        for doc in (d or {}).get('documents',[]):
+            out[doc.get('document_chembl_id')]={'PMID':doc.get('pubmed_id'),'DOI':doc.get('doi'),
+                                                'Journal':doc.get('journal'),'Year':doc.get('year')}
+    return out
+
+def chembl_activities(target_ids:List[str], molecule_ids:List[str], deadline:Optional[Deadline]=None)->pd.DataFrame:
     rows=[]; base="https://www.ebi.ac.uk/chembl/api/data/activity.json"
-    std_types={'Ki','Kd','IC50','EC50'}
-    for tid in target_ids:
+    std_types={'KI','KD','IC50','EC50'}
+    truncated=False
+    wanted=set(molecule_ids)
+    ordered=sorted(wanted)
+    chunks=[ordered[i:i+CHEMBL_ID_CHUNK] for i in range(0, len(ordered), CHEMBL_ID_CHUNK)] or [None]
+    for tid, chunk in ((t, c) for t in target_ids for c in chunks):
         off=0
+        params={'target_chembl_id':tid,'limit':200}
+        if chunk: params['molecule_chembl_id__in']=','.join(chunk)
         while True:
-            r=requests.get(base, params={'target_chembl_id':tid,'limit':200,'offset':off},
-                           timeout=25, headers={'User-Agent':'DTA-OnlineFetcher/1.0'})
+            if deadline and deadline.expired():
+                truncated=True; break
+            try:
+                r, body, complete=get_within(base, params={**params,'offset':off}, timeout=25, deadline=deadline)
+            except Exception:
+                if deadline and deadline.expired(): truncated=True
+                break
+            if not complete:
+                truncated=True; break
             if not r.ok: break
-            acts=r.json().get('activities',[])
+            acts=json.loads(body).get('activities',[])
             if not acts: break
             for a in acts:
                 st=(a.get('standard_type') or '').upper()
                 if st in std_types:
-                    if molecule_ids and a.get('molecule_chembl_id') not in set(molecule_ids): 
+                    if wanted and a.get('molecule_chembl_id') not in wanted:
                         continue
                     rows.append({
                         'source':'chembl','target_chembl_id':tid,'molecule_chembl_id':a.get('molecule_chembl_id'),
+                        'parent_chembl_id':a.get('parent_molecule_chembl_id'),
                         'standard_type':a.get('standard_type'),'standard_value':a.get('standard_value'),
                         'standard_units':a.get('standard_units'),'relation':a.get('standard_relation'),
-                        'ligand_name':a.get('molecule_pref_name'),'PMID':a.get('pmid'),'DOI':a.get('doi'),
-                        'Journal':a.get('journal'),'Year':a.get('year')
+                        'ligand_name':a.get('molecule_pref_name'),'document_chembl_id':a.get('document_chembl_id'),
+                        'PMID':None,'DOI':None,'Journal':a.get('document_journal'),'Year':a.get('document_year')
                     })
             off+=200
-            if off>6000: break
-    return pd.DataFrame(rows)
-
-def iuphar_ligand_ids_by_name(name:str)->List[int]:
-    data=http_get_json("https://www.guidetopharmacology.org/services/ligands", params={'name':name})
+            if off>6000:
+                truncated=True; break
+        if truncated and deadline and deadline.hit: break
+    docs=chembl_documents([r['document_chembl_id'] for r in rows], deadline=deadline)
+    for row in rows:
+        doc=docs.get(row['document_chembl_id'])
+        if doc: row.update({k:v for k,v in doc.items() if v is not None})
+    df=pd.DataFrame(rows); df.attrs['truncated']=truncated
+    return df
+
+def iuphar_ligand_ids_by_name(name:str, deadline:Optional[Deadline]=None)->List[int]:
+    data=http_get_json("https://www.guidetopharmacology.org/services/ligands", params={'name':name}, deadline=deadline)
     return [int(d['ligandId']) for d in (data or []) if 'ligandId' in d]
 
-def iuphar_affinities(ligand_ids:List[int], uniprot:Optional[str])->pd.DataFrame:
-    rows=[]
+def iuphar_affinities(ligand_ids:List[int], uniprot:Optional[str], deadline:Optional[Deadline]=None)->pd.DataFrame:
+    rows=[]; truncated=False
     for lid in ligand_ids:
-        data=http_get_json(f"https://www.guidetopharmacology.org/services/ligands/{lid}/interactions")
+        if deadline and deadline.expired():
+            truncated=True; break
+        data=http_get_json(f"https://www.guidetopharmacology.org/services/ligands/{lid}/interactions", deadline=deadline)
         if not isinstance(data,list): continue
         for it in data:
             tgt=it.get('target',{}) if isinstance(it.get('target'),dict) else {}
@@ -165,19 +316,25 @@ def iuphar_affinities(ligand_ids:List[int], uniprot:Optional[str])->pd.DataFrame
             rows.append({'source':'iuphar','ligandId':lid,'target_name':tgt.get('name'),
                          'uniprot':up,'type':atype,'relation':relation,
                          'value':value,'units':units,'PMID':pmid})
-    return pd.DataFrame(rows)
+    df=pd.DataFrame(rows); df.attrs['truncated']=truncated
+    return df
 
-def bindingdb_online(drug_name:str, protein:str)->pd.DataFrame:
+def bindingdb_online(drug_name:str, protein:str, deadline:Optional[Deadline]=None)->pd.DataFrame:
     try:
-        import requests
         from bs4 import BeautifulSoup
     except Exception:
         eprint('[WARN] BeautifulSoup not installed; skip BindingDB online')
         return pd.DataFrame()
     base="https://www.bindingdb.org/rwd/bind/chemsearch/marvin/SummaryBindingPage.jsp"
-    r=requests.get(base, params={'LigandSearch':drug_name,'target':protein}, timeout=20, headers={'User-Agent':'DTA-OnlineFetcher/1.0'})
+    if deadline and deadline.expired(): return pd.DataFrame()
+    try:
+        r, body, complete=get_within(base, params={'LigandSearch':drug_name,'target':protein}, timeout=20, deadline=deadline)
+    except Exception:
+        if deadline: deadline.expired()
+        return pd.DataFrame()
     if not r.ok: return pd.DataFrame()
-    soup=BeautifulSoup(r.text,'html.parser')
+    # a page cut off by the deadline is still parsed; html.parser tolerates the truncation
+    soup=BeautifulSoup(body.decode(r.encoding or 'utf-8', errors='replace'),'html.parser')
     rows=[]
     for tbl in soup.find_all('table'):
         headers=[th.get_text(strip=True) for th in tbl.find_all('th')]
@@ -186,7 +343,8 @@ def bindingdb_online(drug_name:str, protein:str)->pd.DataFrame:
         for tr in tbl.find_all('tr'):
             tds=[td.get_text(' ', strip=True) for td in tr.find_all('td')]
             if len(tds)>=3: rows.append({'raw':' | '.join(tds)})
-    df=pd.DataFrame(rows); df['source']='bindingdb-online'; return df
+    df=pd.DataFrame(rows); df['source']='bindingdb-online'; df.attrs['truncated']=not complete
+    return df
 
 RUBRIC=[('Very high',0,1.0),('High',1.0,10.0),('Strong',10.0,100.0),('Moderate',100.0,1000.0),('Weak',1000.0,10000.0),('Very weak/None',10000.0,float('inf'))]
 
@@ -210,6 +368,116 @@ def to_nm(val, units)->Optional[float]:
     if u.startswith('pm'): return v*0.001
     return v
 
+def to_nm_series(values, units)->pd.Series:
+    """Vectorized to_nm: same unit rules, NaN where the value does not parse."""
+    v=pd.to_numeric(pd.Series(values).reset_index(drop=True), errors='coerce')
+    u=pd.Series(units).reset_index(drop=True).reindex(v.index).fillna('nM').astype(str).str.lower().str.replace('µ','u',regex=False)
+    factor=np.select([u.str.startswith('nm'),u.str.startswith('um'),u.str.startswith('mm'),u.str.startswith('pm')],
+                     [1.0,1000.0,1_000_000.0,0.001], default=1.0)
+    return v*factor
+
+AFFINITY_TYPES=['Ki','Kd','IC50','EC50']
+UNIFIED_COLS=['source','compound_key','uniprot','standard_type','relation','value_nM','PMID','DOI','record_id']
+
+def compound_key(meta)->str:
+    if meta.get('inchikey'): return str(meta['inchikey']).strip().upper()
+    if meta.get('cid'): return f"CID:{meta['cid']}"
+    return f"NAME:{str(meta.get('drug_name','')).strip().lower()}"
+
+def unified_records(df_chembl, df_pubchem, df_iuphar, meta)->pd.DataFrame:
+    """Stack ChEMBL, PubChem and IUPHAR rows into one long table of affinities in nM.
+
+    `compound_key` is per row: ChEMBL rows use their parent molecule, mapped to the
+    query compound only when the parent is in meta['chembl_parents']; IUPHAR rows
+    use their ligand unless a single ligand matched; PubChem rows are CID-scoped.
+    """
+    def col(df, name): return df[name] if name in df.columns else pd.Series([None]*len(df), index=df.index)
+    query=compound_key(meta)
+    parts=[]
+    if not df_chembl.empty:
+        parent=col(df_chembl,'parent_chembl_id').fillna(col(df_chembl,'molecule_chembl_id')).astype(str)
+        ckey=('CHEMBL:'+parent).where(~parent.isin(meta.get('chembl_parents') or []), query)
+        parts.append(pd.DataFrame({'source':'chembl','compound_key':ckey.values,'standard_type':col(df_chembl,'standard_type').values,
+            'relation':col(df_chembl,'relation').values,
+            'value_nM':to_nm_series(col(df_chembl,'standard_value'), col(df_chembl,'standard_units')).values,
+            'PMID':col(df_chembl,'PMID').values,'DOI':col(df_chembl,'DOI').values,
+            'record_id':col(df_chembl,'molecule_chembl_id').values}))
+    types=[t for t in AFFINITY_TYPES if t in df_pubchem.columns]
+    if not df_pubchem.empty and types:
+        pc=df_pubchem.assign(PMID=col(df_pubchem,'PMID'), AID=col(df_pubchem,'AID'))
+        long=pc.melt(id_vars=['AID','PMID'], value_vars=types, var_name='standard_type', value_name='value')
+        parts.append(pd.DataFrame({'source':'pubchem','compound_key':query,'standard_type':long['standard_type'].values,'relation':None,
+            'value_nM':to_nm_series(long['value'], 'nM').values,'PMID':long['PMID'].values,'DOI':None,
+            'record_id':long['AID'].values}))
+    if not df_iuphar.empty:
+        ikey=('IUPHAR:'+col(df_iuphar,'ligandId').astype(str)).values
+        if len(meta.get('iuphar_ligands') or [])==1: ikey=query
+        parts.append(pd.DataFrame({'source':'iuphar','compound_key':ikey,'standard_type':col(df_iuphar,'type').values,
+            'relation':col(df_iuphar,'relation').values,
+            'value_nM':to_nm_series(col(df_iuphar,'value'), col(df_iuphar,'units')).values,
+            'PMID':col(df_iuphar,'PMID').values,'DOI':None,'record_id':col(df_iuphar,'ligandId').values}))
+    if not parts: return pd.DataFrame(columns=UNIFIED_COLS)
+    out=pd.concat(parts, ignore_index=True)
+    canon={t.upper():t for t in AFFINITY_TYPES}
+    out['standard_type']=out['standard_type'].astype(str).str.strip().str.upper().map(canon)
+    out=out.dropna(subset=['standard_type','value_nM']).reset_index(drop=True)
+    out['uniprot']=str(meta.get('uniprot') or '').upper()
+    return out[UNIFIED_COLS]
+
+def _round_sig(v:pd.Series, sig:int)->pd.Series:
+    a=v.abs().where(v!=0, 1.0)
+    scale=10.0**(np.floor(np.log10(a))-sig+1)
+    return (v/scale).round()*scale
+
+def dedupe_records(df:pd.DataFrame, sig:int=3, scope:Optional[str]=None)->pd.DataFrame:
+    """Collapse the same literature measurement reported by several sources.
+
+    Rows share a hashed key of (row compound, UniProt, standard_type, value rounded
+    to `sig` significant figures, PMID or DOI). Rows without any reference are
+    never merged, and rows from the same source are separate assays: the k-th
+    ChEMBL row of a key only merges with the k-th row of other sources. With
+    `scope` (e.g. 'pair'), same-source rows from different scope groups do merge;
+    make_per_source_reports.py --root uses this to build records_unified_batch.csv.
+    The first row per key is kept; `sources`/`n_sources`/`n_merged` record
+    provenance and accumulate when re-deduplicating already merged tables.
+    """
+    if df.empty: return df.assign(record_key=pd.Series(dtype='uint64'), sources='', n_sources=0, n_merged=0)
+    df=df.reset_index(drop=True)
+    def norm(s): return s.astype('string').str.strip().str.replace(r'\.0$','',regex=True).fillna('')
+    pmid=norm(df['PMID']); doi=norm(df['DOI']).str.lower()
+    ref=('PMID:'+pmid).where(pmid!='', ('DOI:'+doi).where(doi!='', 'ROW:'+df.index.astype(str)))
+    keyframe=pd.DataFrame({'c':df['compound_key'].astype(str).str.upper(),'u':df['uniprot'].astype(str).str.upper(),
+                           't':df['standard_type'].astype(str),'v':_round_sig(df['value_nM'].astype(float), sig),'r':ref})
+    key=pd.util.hash_pandas_object(keyframe, index=False)
+    occ=key.groupby([key, df['source']]+([df[scope]] if scope else [])).cumcount()
+    key=pd.util.hash_pandas_object(pd.DataFrame({'k':key,'o':occ}), index=False)
+    # provenance as a bitmask of contributing sources, decoded once per distinct mask
+    prov=(df['sources'] if 'sources' in df.columns else df['source']).fillna('').astype(str)
+    names=sorted(set(';'.join(prov.unique()).split(';'))-{''})
+    padded=';'+prov+';'
+    bits=pd.DataFrame({n:padded.str.contains(f';{n};', regex=False) for n in names})
+    hit=bits.groupby(key.values).max()
+    mask=sum(hit[n].astype('int64')*(1<<i) for i,n in enumerate(names))
+    decode={m:';'.join(n for i,n in enumerate(names) if m>>i & 1) for m in mask.unique()}
+    weight=pd.to_numeric(df['n_merged'], errors='coerce').fillna(1) if 'n_merged' in df.columns else pd.Series(1, index=df.index)
+    merged=weight.groupby(key.values).sum()
+    first=~key.duplicated()
+    out=df.loc[first].drop(columns=['record_key','sources','n_sources','n_merged'], errors='ignore')
+    out['record_key']=key[first].values
+    m=mask.reindex(out['record_key']).values
+    out['sources']=pd.Series(m).map(decode).values
+    out['n_sources']=pd.Series(m).map({k:v.count(';')+1 for k,v in decode.items()}).values
+    out['n_merged']=merged.reindex(out['record_key']).astype('int64').values
+    return out.reset_index(drop=True)
+
+def summarize_records(df:pd.DataFrame)->dict:
+    summaries={}
+    if df.empty: return summaries
+    for t in AFFINITY_TYPES:
+        s=summarize_numeric(df.loc[df['standard_type']==t,'value_nM'].tolist())
+        if s: summaries[t]=s
+    return summaries
+
 def summarize_numeric(vals)->dict:
     arr=[float(x) for x in vals if x is not None and not pd.isna(x)]
     if not arr: return {}
@@ -239,7 +507,15 @@ def best_key(summaries):
         if k in summaries: return k
     return None
 
-def render_report(meta, summaries, out_path:Path):
+def source_status_lines(sources)->List[str]:
+    lines=[]
+    for name, st in (sources or {}).items():
+        if not (st.get('timed_out') or st.get('truncated')): continue
+        why='timed out' if st.get('timed_out') else 'page limit reached'
+        lines.append(f"- **{name}**: partial results ({why} after {st.get('elapsed_s',0):.3g} s, rows={st.get('rows',0)})")
+    return lines
+
+def render_report(meta, summaries, out_path:Path, sources=None):
     lines=[]
     lines.append('# Online Binding Report'); lines.append('')
     lines.append(f"**Ligand**: `{meta.get('drug_name','')}` | **SMILES**: `{meta.get('smiles','')}` | **CID**: `{meta.get('cid','')}`")
@@ -252,9 +528,15 @@ def render_report(meta, summaries, out_path:Path):
             s=summaries.get(key); 
             if not s: continue
             lines.append(f"- **{key}**: n={s['n']}, median={s['median_nM']:.3g} nM, min={s['min_nM']:.3g} nM, max={s['max_nM']:.3g} nM → **{classify(s['min_nM'])}** (best)")
+    status=source_status_lines(sources)
+    if status:
+        lines.append(''); lines.append('## Source status')
+        lines += status
+        lines.append('- Summaries above only cover the rows fetched before the budget/limit; re-run with a larger `--deadline`/`--budget` for complete data.')
     lines.append('')
     lines.append('## Interpretation (detailed)')
     lines.append('- Assays across sources (ChEMBL/PubChem/IUPHAR/BindingDB) can differ in format and conditions; values are normalized to nM, but heterogeneity remains.')
+    lines.append('- The same literature measurement reported by several sources is counted once (see `records_unified.csv`).')
     key = best_key(summaries)
     if key:
         s = summaries[key]
@@ -283,6 +565,32 @@ def render_report(meta, summaries, out_path:Path):
         lines.append('- No quantitative values parsed; try other names/SMILES or check UniProt mapping in the FASTA header.')
     out_path.write_text('\n'.join(lines), encoding='utf-8')
 
+SOURCES=['chembl','pubchem','iuphar','bindingdb']
+
+def parse_budgets(items)->Dict[str,float]:
+    budgets={}
+    for it in items or []:
+        name, _, secs=it.partition('=')
+        name=name.strip().lower()
+        bad=ValueError(f'bad --budget {it!r}; expected SOURCE=SECONDS with SOURCE in {", ".join(SOURCES)} and SECONDS > 0')
+        if name not in SOURCES: raise bad
+        try: secs=float(secs)
+        except ValueError: raise bad from None
+        if not secs>0: raise bad
+        budgets[name]=secs
+    return budgets
+
+def fetch_source(name, fn, deadline:Deadline, budgets:Dict[str,float]):
+    """Run one source fetcher under its own budget; returns (DataFrame, status dict)."""
+    dl=Deadline(budgets.get(name), parent=deadline)
+    t0=time.monotonic()
+    df=pd.DataFrame() if dl.expired() else fn(dl)
+    status={'rows':int(len(df)),'timed_out':dl.hit,
+            'truncated':dl.hit or bool(df.attrs.get('truncated')),
+            'elapsed_s':round(time.monotonic()-t0,2)}
+    if dl.hit: eprint(f'[WARN] {name}: budget expired, keeping {len(df)} partial rows')
+    return df, status
+
 def main(argv=None):
     ap=argparse.ArgumentParser(description='Online DTA fetcher (ChEMBL, PubChem, IUPHAR, BindingDB)')
     ap.add_argument('--drug-name', type=str, help='Ligand name (e.g., Lapatinib)')
@@ -291,87 +599,104 @@ def main(argv=None):
     ap.add_argument('--outdir', type=str, default='./results')
     ap.add_argument('--pubchem-keep-all', action='store_true',
                     help='Do not filter PubChem assays by gene/target name.')
+    ap.add_argument('--deadline', type=float, default=None,
+                    help='Overall time budget in seconds for the whole pair; slow sources return partial results.')
+    ap.add_argument('--chembl-cache', type=str, default=None,
+                    help=f'JSON cache of InChIKey -> ChEMBL molecule ids (default: {CHEMBL_CACHE_NAME} next to --outdir, i.e. the results root)')
+    ap.add_argument('--chembl-cache-refresh', action='store_true',
+                    help='Ignore the cached ChEMBL ids for this InChIKey and look them up again.')
+    ap.add_argument('--budget', action='append', default=[], metavar='SOURCE=SECONDS',
+                    help=f'Per-source time budget (repeatable), SOURCE in {", ".join(SOURCES)}.')
     args=ap.parse_args(argv)
+    try:
+        budgets=parse_budgets(args.budget)
+    except ValueError as e:
+        eprint('ERROR:', e); return 2
+    if args.deadline is not None and not args.deadline>0:
+        eprint('ERROR: --deadline must be > 0 seconds'); return 2
+    deadline=Deadline(args.deadline)
 
     outdir=Path(args.outdir); outdir.mkdir(parents=True, exist_ok=True)
+    chembl_cache=Path(args.chembl_cache) if args.chembl_cache else outdir.resolve().parent/CHEMBL_CACHE_NAME
 
     header, seq=parse_fasta_header_and_seq(Path(args.protein))
     uniprot=extract_uniprot_from_header(header) or ''
     gene=extract_gene_from_header(header) or ''
     pname=extract_protein_name_from_header(header) or (header.split()[0] if header else '')
 
-    dname=''; smiles=''; cid=None
+    dname=''; smiles=''; cid=None; inchikey=None
     if args.smiles:
         dname=args.drug_name or ''
-        res=resolve_pubchem_by_smiles(args.smiles)
+        res=resolve_pubchem_by_smiles(args.smiles, deadline=deadline)
         smiles=res.get('smiles') or args.smiles
-        cid=res.get('cid')
+        cid=res.get('cid'); inchikey=res.get('inchikey')
     elif args.drug_name:
         dname=args.drug_name
-        res=resolve_pubchem_by_name(dname)
+        res=resolve_pubchem_by_name(dname, deadline=deadline)
         smiles=res.get('smiles') or ''
-        cid=res.get('cid')
+        cid=res.get('cid'); inchikey=res.get('inchikey')
     if not (args.smiles or args.drug_name):
         eprint('ERROR: provide --drug-name or --smiles'); return 2
 
-    chembl_t=chembl_targets_by_uniprot(uniprot) if uniprot else []
-    chembl_m=chembl_molecule_ids_by_name(dname) if dname else []
-    df_chembl=chembl_activities(chembl_t, chembl_m) if chembl_t else pd.DataFrame()
+    def _chembl(dl):
+        chembl_t=chembl_targets_by_uniprot(uniprot, deadline=dl) if uniprot else []
+        chembl_m, query=chembl_molecule_ids_by_inchikey(inchikey, deadline=dl, cache_path=chembl_cache,
+                                                                refresh=args.chembl_cache_refresh) if inchikey else ([], [])
+        if not chembl_m and dname:
+            chembl_m, query=chembl_molecule_ids_by_name(dname, deadline=dl)
+        df=chembl_activities(chembl_t, chembl_m, deadline=dl) if chembl_t and chembl_m else pd.DataFrame()
+        df.attrs['query_parents']=query  # parents that are the query compound, for unified_records
+        return df
+    sources={}
+    df_chembl, sources['chembl']=fetch_source('chembl', _chembl, deadline, budgets)
 
-    df_pubchem=pd.DataFrame()
     if dname and not cid:
-        res=resolve_pubchem_by_name(dname); cid=res.get('cid') or cid
-    if cid:
-        df_pubchem=pubchem_assay_summary(cid)
-        if (not args.pubchem_keep_all) and (gene or pname) and not df_pubchem.empty:
-            patt=(gene or pname or '').lower()
-            df_pubchem = df_pubchem.assign(
-                _t=df_pubchem['GeneSymbol'].astype(str).str.lower() + ' ' +
-                   df_pubchem['TargetName'].astype(str).str.lower()
-            )
-            df_pubchem = df_pubchem.loc[df_pubchem['_t'].str.contains(patt, na=False)]
-            df_pubchem = df_pubchem.drop(columns=['_t'])
-
-    df_iuphar=pd.DataFrame()
-    if dname:
-        lids=iuphar_ligand_ids_by_name(dname)
-        if lids: df_iuphar=iuphar_affinities(lids, uniprot if uniprot else None)
-
-    df_bdb=pd.DataFrame()
-    if dname and (uniprot or pname): df_bdb=bindingdb_online(dname, uniprot or pname)
-
-    summaries={}
-    if not df_chembl.empty:
-        for t in ['Ki','Kd','IC50','EC50']:
-            vals=df_chembl[df_chembl['standard_type'].astype(str).str.upper()==t][['standard_value','standard_units']]
-            arr=[to_nm(v,u) for v,u in zip(vals['standard_value'], vals['standard_units'])]
-            s=summarize_numeric(arr)
-            if s: summaries[t]=s
-    if not df_pubchem.empty:
-        for t in ['Ki','Kd','IC50','EC50']:
-            if t in df_pubchem.columns:
-                arr=[to_nm(x,'nM') for x in df_pubchem[t].tolist()]
-                s=summarize_numeric(arr)
-                if s:
-                    if t in summaries:
-                        cur=summaries[t]
-                        merged = summarize_numeric([cur['median_nM'], cur['min_nM'], cur['max_nM']] + arr)
-                        summaries[t]=merged
-                    else:
-                        summaries[t]=s
+        res=resolve_pubchem_by_name(dname, deadline=deadline); cid=res.get('cid') or cid
+    df_pubchem, sources['pubchem']=fetch_source(
+        'pubchem', lambda dl: pubchem_assay_summary(cid, deadline=dl) if cid else pd.DataFrame(), deadline, budgets)
+    if (not args.pubchem_keep_all) and (gene or pname) and not df_pubchem.empty:
+        patt=(gene or pname or '').lower()
+        df_pubchem = df_pubchem.assign(
+            _t=df_pubchem['GeneSymbol'].astype(str).str.lower() + ' ' +
+               df_pubchem['TargetName'].astype(str).str.lower()
+        )
+        df_pubchem = df_pubchem.loc[df_pubchem['_t'].str.contains(patt, na=False)]
+        df_pubchem = df_pubchem.drop(columns=['_t'])
+    sources['pubchem']['rows']=int(len(df_pubchem))
+
+    def _iuphar(dl):
+        lids=iuphar_ligand_ids_by_name(dname, deadline=dl) if dname else []
+        df=iuphar_affinities(lids, uniprot if uniprot else None, deadline=dl) if lids else pd.DataFrame()
+        df.attrs['ligand_ids']=lids
+        return df
+    df_iuphar, sources['iuphar']=fetch_source('iuphar', _iuphar, deadline, budgets)
+
+    df_bdb, sources['bindingdb']=fetch_source(
+        'bindingdb', lambda dl: bindingdb_online(dname, uniprot or pname, deadline=dl) if dname and (uniprot or pname) else pd.DataFrame(),
+        deadline, budgets)
+
+    meta={'drug_name':dname,'smiles':smiles,'cid':cid or '','inchikey':inchikey or '',
+          'uniprot':uniprot,'gene':gene,'protein_name':pname,
+          'chembl_parents':df_chembl.attrs.get('query_parents',[]),
+          'iuphar_ligands':df_iuphar.attrs.get('ligand_ids',[])}
+    df_all=unified_records(df_chembl, df_pubchem, df_iuphar, meta)
+    df_unified=dedupe_records(df_all)
+    summaries=summarize_records(df_unified)
 
     df_chembl.to_csv(outdir/'chembl_records.csv', index=False, encoding='utf-8')
     df_pubchem.to_csv(outdir/'pubchem_records.csv', index=False, encoding='utf-8')
     df_iuphar.to_csv(outdir/'iuphar_records.csv', index=False, encoding='utf-8')
     df_bdb.to_csv(outdir/'bindingdb_online_raw.csv', index=False, encoding='utf-8')
+    df_unified.to_csv(outdir/'records_unified.csv', index=False, encoding='utf-8')
 
-    meta={'drug_name':dname,'smiles':smiles,'cid':cid or '',
-          'uniprot':uniprot,'gene':gene,'protein_name':pname}
-    (outdir/'summary.json').write_text(json.dumps({'meta':meta, 'summaries':summaries}, ensure_ascii=False, indent=2), encoding='utf-8')
-    render_report(meta, summaries, outdir/'report_online.md')
+    (outdir/'summary.json').write_text(json.dumps({'meta':meta, 'summaries':summaries, 'sources':sources}, ensure_ascii=False, indent=2), encoding='utf-8')
+    render_report(meta, summaries, outdir/'report_online.md', sources)
 
     print('[OK] Online fetch complete.')
     print(f" ChEMBL rows: {len(df_chembl)} | PubChem assays: {len(df_pubchem)} | IUPHAR rows: {len(df_iuphar)} | BindingDB rows: {len(df_bdb)}")
+    print(f" Unified measurements: {len(df_unified)} (from {len(df_all)} rows, {len(df_all)-len(df_unified)} cross-source duplicates merged)")
+    partial=[k for k,st in sources.items() if st['truncated']]
+    if partial: print(' Partial (budget/limit):', ', '.join(partial))
     if summaries:
         parts=[]
         for k in ['Ki','Kd','IC50','EC50']:
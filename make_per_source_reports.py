@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-import json, sys, math, argparse
+import json, sys, math, argparse, hashlib, os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
 import numpy as np
@@ -109,13 +110,23 @@ def make_interpretation(title, summaries, n_records):
     lines += [f"- {x}" for x in nexts]
     return "\n".join(lines)
 
-def report_lines(title, meta, summaries, source_n):
+def status_note(status):
+    if not status or not (status.get("timed_out") or status.get("truncated")):
+        return None
+    why = "the time budget expired" if status.get("timed_out") else "the page limit was reached"
+    return f"> **Partial results**: fetching stopped early because {why} (timed_out={bool(status.get('timed_out'))}, truncated={bool(status.get('truncated'))}, rows={status.get('rows',0)}). Summaries cover only the rows retrieved."
+
+def report_lines(title, meta, summaries, source_n, status=None):
     lines=[]
     lines.append(f"# {title}")
     lines.append("")
     lines.append(f"**Ligand**: `{meta.get('drug_name','')}` | **SMILES**: `{meta.get('smiles','')}` | **CID**: `{meta.get('cid','')}`")
     lines.append(f"**Target**: `{meta.get('protein_name','')}` | **UniProt**: `{meta.get('uniprot','')}` | **Gene**: `{meta.get('gene','')}`")
     lines.append("")
+    note=status_note(status)
+    if note:
+        lines.append(note)
+        lines.append("")
     lines.append("## Summary (normalized to nM)")
     if not summaries:
         lines.append("_No quantitative affinities found._")
@@ -143,21 +154,47 @@ def safe_read_csv(path: Path)->pd.DataFrame:
     except Exception:
         return pd.DataFrame()
 
-def write_chembl_report(outdir, meta):
+def unified_summaries(outdir, source):
+    """Summaries from the deduplicated records_unified.csv for rows `source` contributed to; None if absent."""
+    p=outdir/"records_unified.csv"
+    if not p.exists(): return None
+    df=safe_read_csv(p)
+    summaries={}
+    if df.empty or "sources" not in df.columns: return summaries
+    df=df[(";"+df["sources"].fillna("")+";").str.contains(f";{source};", regex=False)]
+    for t in ["Ki","Kd","IC50","EC50"]:
+        s=summarize_numeric(pd.to_numeric(df.loc[df["standard_type"]==t,"value_nM"], errors="coerce").tolist())
+        if s: summaries[t]=s
+    return summaries
+
+def write_chembl_report(outdir, meta, status=None):
     df=safe_read_csv(outdir/"chembl_records.csv")
+    summaries=unified_summaries(outdir, "chembl")
+    if summaries is None:
+        summaries=legacy_chembl_summaries(df)
+    n = int(df.shape[0]) if not df.empty else 0
+    (outdir/"report_chembl.md").write_text(report_lines("ChEMBL Report", meta, summaries, n, status), encoding="utf-8")
+
+def legacy_chembl_summaries(df):
     summaries={}
     if not df.empty and "standard_type" in df.columns:
         for t in ["Ki","Kd","IC50","EC50"]:
-            sub=df[df["standard_type"].astype(str).str.upper()==t]
+            sub=df[df["standard_type"].astype(str).str.upper()==t.upper()]
             if sub.empty: continue
             arr=[to_nm(v,u) for v,u in zip(sub.get("standard_value",[]), sub.get("standard_units",[]))]
             s=summarize_numeric(arr)
             if s: summaries[t]=s
-    n = int(df.shape[0]) if not df.empty else 0
-    (outdir/"report_chembl.md").write_text(report_lines("ChEMBL Report", meta, summaries, n), encoding="utf-8")
+    return summaries
 
-def write_pubchem_report(outdir, meta):
+def write_pubchem_report(outdir, meta, status=None):
     df=safe_read_csv(outdir/"pubchem_records.csv")
+    summaries=unified_summaries(outdir, "pubchem")
+    if summaries is None:
+        summaries=legacy_pubchem_summaries(df)
+    n = int(df.shape[0]) if not df.empty else 0
+    (outdir/"report_pubchem.md").write_text(report_lines("PubChem Report", meta, summaries, n, status), encoding="utf-8")
+
+def legacy_pubchem_summaries(df):
     summaries={}
     if not df.empty:
         for t in ["Ki","Kd","IC50","EC50"]:
@@ -165,23 +202,28 @@ def write_pubchem_report(outdir, meta):
                 arr=[to_nm(x,"nM") for x in df[t].tolist()]
                 s=summarize_numeric(arr)
                 if s: summaries[t]=s
-    n = int(df.shape[0]) if not df.empty else 0
-    (outdir/"report_pubchem.md").write_text(report_lines("PubChem Report", meta, summaries, n), encoding="utf-8")
+    return summaries
 
-def write_iuphar_report(outdir, meta):
+def write_iuphar_report(outdir, meta, status=None):
     df=safe_read_csv(outdir/"iuphar_records.csv")
+    summaries=unified_summaries(outdir, "iuphar")
+    if summaries is None:
+        summaries=legacy_iuphar_summaries(df)
+    n = int(df.shape[0]) if not df.empty else 0
+    (outdir/"report_iuphar.md").write_text(report_lines("IUPHAR Report", meta, summaries, n, status), encoding="utf-8")
+
+def legacy_iuphar_summaries(df):
     summaries={}
     if not df.empty and "type" in df.columns:
         for t in ["Ki","Kd","IC50","EC50"]:
-            sub=df[df["type"].astype(str).str.upper()==t]
+            sub=df[df["type"].astype(str).str.upper()==t.upper()]
             if sub.empty: continue
             values=[to_nm(v,u) for v,u in zip(sub.get("value",[]), sub.get("units",[]))]
             s=summarize_numeric(values)
             if s: summaries[t]=s
-    n = int(df.shape[0]) if not df.empty else 0
-    (outdir/"report_iuphar.md").write_text(report_lines("IUPHAR Report", meta, summaries, n), encoding="utf-8")
+    return summaries
 
-def write_bindingdb_note(outdir, meta):
+def write_bindingdb_note(outdir, meta, status=None):
     p=outdir/"bindingdb_online_raw.csv"
     title="BindingDB Online Report"
     if not p.exists() or p.stat().st_size==0:
@@ -190,22 +232,158 @@ def write_bindingdb_note(outdir, meta):
         text=[f"# {title}","",f"**Ligand**: `{meta.get('drug_name','')}` | **Target**: `{meta.get('protein_name','')}`","",
               "Raw HTML rows saved (not fully numeric-parsed in this helper).",
               f"- File: `{p.name}`"]
+    note=status_note(status)
+    if note: text += ["", note]
     (outdir/"report_bindingdb.md").write_text("\n".join(text), encoding="utf-8")
 
+REPORT_INPUTS=["summary.json","records_unified.csv","chembl_records.csv","pubchem_records.csv","iuphar_records.csv","bindingdb_online_raw.csv"]
+REPORT_OUTPUTS=["report_online.md","report_chembl.md","report_pubchem.md","report_iuphar.md","report_bindingdb.md"]
+STAMP_NAME=".reports_stamp"
+# report_online.md's rubric/template lives in binding_fetch_online.render_report
+TEMPLATE_SOURCES=[Path(__file__), Path(__file__).with_name("binding_fetch_online.py")]
+
+def inputs_fingerprint(outdir):
+    """sha1 over the report templates (both scripts) and every input file present in outdir."""
+    h=hashlib.sha1()
+    for p in TEMPLATE_SOURCES:
+        h.update(p.read_bytes())
+    for name in REPORT_INPUTS:
+        p=outdir/name
+        if p.exists():
+            h.update(name.encode("utf-8")); h.update(p.read_bytes())
+    return h.hexdigest()
+
+def is_stale(outdir, mode="mtime"):
+    outputs=[outdir/n for n in REPORT_OUTPUTS]
+    if not all(p.exists() for p in outputs): return True
+    if mode=="hash":
+        stamp=outdir/STAMP_NAME
+        return not stamp.exists() or stamp.read_text(encoding="utf-8").strip()!=inputs_fingerprint(outdir)
+    inputs=[outdir/n for n in REPORT_INPUTS if (outdir/n).exists()]+TEMPLATE_SOURCES
+    return min(p.stat().st_mtime for p in outputs) < max(p.stat().st_mtime for p in inputs)
+
+def write_reports(outdir):
+    from binding_fetch_online import render_report
+    summary=json.loads((outdir/"summary.json").read_text(encoding="utf-8"))
+    meta=summary.get("meta", {})
+    sources=summary.get("sources", {})
+    render_report(meta, summary.get("summaries", {}), outdir/"report_online.md", sources)
+    write_chembl_report(outdir, meta, sources.get("chembl"))
+    write_pubchem_report(outdir, meta, sources.get("pubchem"))
+    write_iuphar_report(outdir, meta, sources.get("iuphar"))
+    write_bindingdb_note(outdir, meta, sources.get("bindingdb"))
+    (outdir/STAMP_NAME).write_text(inputs_fingerprint(outdir), encoding="utf-8")
+
+def refresh_outdir(outdir, mode="mtime", force=False):
+    """Worker for --root: returns (outdir, 'written'|'skipped'|'error: ...')."""
+    outdir=Path(outdir)
+    try:
+        if not force and not is_stale(outdir, mode): return str(outdir), "skipped"
+        write_reports(outdir)
+        return str(outdir), "written"
+    except Exception as e:
+        return str(outdir), f"error: {e}"
+
+def discover_outdirs(root):
+    return sorted(p.parent for p in Path(root).rglob("summary.json"))
+
+def best_entry(summaries):
+    """(best nM, metric, n) over all affinity types, or None."""
+    best=None
+    for k in ["Ki","Kd","IC50","EC50"]:
+        s=summaries.get(k)
+        if s and (best is None or s["min_nM"]<best[0]): best=(s["min_nM"], k, s["n"])
+    return best
+
+def write_index(root, outdirs):
+    root=Path(root)
+    rows=[]; unparsed=[]; unreadable=[]
+    for d in outdirs:
+        try:
+            summary=json.loads((d/"summary.json").read_text(encoding="utf-8"))
+        except Exception:
+            # the render step already printed a [WARN] for this folder
+            unreadable.append(d); continue
+        meta=summary.get("meta", {})
+        best=best_entry(summary.get("summaries", {}))
+        if not best:
+            unparsed.append(d); continue
+        partial=[k for k,st in summary.get("sources", {}).items() if st.get("timed_out") or st.get("truncated")]
+        rows.append((best[0], best[1], best[2], d, meta, partial))
+    rows.sort(key=lambda r: r[0])
+    lines=["# Batch Index","",f"Pairs ranked by best (minimum) affinity in nM across Ki/Kd/IC50/EC50, grouped by rubric class. Root: `{root}`",""]
+    for label,lo,hi in RUBRIC:
+        group=[r for r in rows if lo<=r[0]<hi]
+        if not group: continue
+        lines.append(f"## {label} ({len(group)})")
+        lines.append("")
+        lines.append("| # | Pair | Ligand | Target | Best nM | Metric | n | Partial |")
+        lines.append("|---|------|--------|--------|---------|--------|---|---------|")
+        for i,(nm,key,n,d,meta,partial) in enumerate(group, start=1):
+            rel=d.relative_to(root).as_posix() if d!=root else "."
+            lines.append(f"| {i} | [{rel}]({rel}/report_online.md) | {meta.get('drug_name') or meta.get('smiles','')} | {meta.get('protein_name','')} | {nm:.3g} | {key} | {n} | {', '.join(partial)} |")
+        lines.append("")
+    if unparsed:
+        lines.append(f"## No quantitative values ({len(unparsed)})")
+        lines.append("")
+        lines += [f"- `{d.relative_to(root).as_posix() if d!=root else '.'}`" for d in unparsed]
+        lines.append("")
+    if unreadable:
+        lines.append(f"## Unreadable summary.json ({len(unreadable)})")
+        lines.append("")
+        lines += [f"- `{d.relative_to(root).as_posix() if d!=root else '.'}`" for d in unreadable]
+    (root/"index.md").write_text("\n".join(lines), encoding="utf-8")
+
+def write_batch_records(root, outdirs):
+    """Fold every pair's records_unified.csv into ROOT/records_unified_batch.csv with one dedupe pass."""
+    from binding_fetch_online import dedupe_records
+    root=Path(root)
+    frames=[]
+    for d in outdirs:
+        df=safe_read_csv(d/"records_unified.csv")
+        if not df.empty: frames.append(df.assign(pair=d.relative_to(root).as_posix() if d!=root else "."))
+    if not frames: return 0
+    merged=dedupe_records(pd.concat(frames, ignore_index=True), scope="pair")
+    merged.to_csv(root/"records_unified_batch.csv", index=False, encoding="utf-8")
+    return len(merged)
+
+def main_root(args):
+    outdirs=discover_outdirs(args.root)
+    if not outdirs:
+        print(f"ERROR: no summary.json found under {args.root}"); return 2
+    jobs=args.jobs or os.cpu_count() or 1
+    counts={"written":0,"skipped":0,"error":0}
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        futs=[ex.submit(refresh_outdir, str(d), args.staleness, args.force) for d in outdirs]
+        for f in futs:
+            d, status=f.result()
+            counts[status.split(":")[0]]+=1
+            if status.startswith("error"): print(f"[WARN] {d}: {status}")
+    write_index(args.root, outdirs)
+    n=write_batch_records(args.root, outdirs)
+    print(f"Reports under {args.root}: {counts['written']} written, {counts['skipped']} up to date, {counts['error']} failed.")
+    print(f"Batch index: {Path(args.root)/'index.md'}")
+    if n: print(f"Batch records: {n} unique measurements -> {Path(args.root)/'records_unified_batch.csv'}")
+    return 1 if counts["error"] else 0
+
 def main():
     ap=argparse.ArgumentParser()
     ap.add_argument("--outdir", default="results", help="Folder that contains summary.json and CSV outputs")
+    ap.add_argument("--root", help="Regenerate reports for every folder under ROOT containing summary.json, then write ROOT/index.md")
+    ap.add_argument("--jobs", type=int, default=None, help="Worker processes for --root (default: CPU count)")
+    ap.add_argument("--staleness", choices=["mtime","hash"], default="mtime",
+                    help="How --root decides a folder is up to date: file mtimes or a content hash stamp")
+    ap.add_argument("--force", action="store_true", help="With --root, rewrite reports even if they look up to date")
     args=ap.parse_args()
+    if args.root:
+        return main_root(args)
     outdir=Path(args.outdir)
     meta_path=outdir/"summary.json"
     if not meta_path.exists():
         print(f"ERROR: {meta_path} not found. Run binding_fetch_online.py first."); return 2
-    meta=json.loads(meta_path.read_text(encoding="utf-8")).get("meta", {})
-    write_chembl_report(outdir, meta)
-    write_pubchem_report(outdir, meta)
-    write_iuphar_report(outdir, meta)
-    write_bindingdb_note(outdir, meta)
+    write_reports(outdir)
     print(f"Per-source reports written to {outdir}:")
+    print(" - report_online.md")
     print(" - report_chembl.md")
     print(" - report_pubchem.md")
     print(" - report_iuphar.md")
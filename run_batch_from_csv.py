@@ -34,7 +34,7 @@ def run_one(drug_name, smiles, fasta_path, outdir):
     if r.returncode != 0:
         print(f'[WARN] fetch failed (code {r.returncode}) for: drug={drug_name} smiles={bool(smiles)} fasta={fasta_path}')
         return r.returncode
-    r2 = subprocess.run([PY, 'make_per_source_reports.py'])
+    r2 = subprocess.run([PY, 'make_per_source_reports.py', '--outdir', outdir])
     if r2.returncode != 0:
         print(f'[WARN] per-source reports failed (code {r2.returncode}) for outdir={outdir}')
     return 0
@@ -52,7 +52,7 @@ def main():
         for i, row in enumerate(reader, start=1):
             drug_name = (row.get('drug_name') or '').strip()
             smiles = (row.get('smiles') or '').strip()
-            fasta_path = (row.get('fasta_path') or '').strip().replace('\','/')
+            fasta_path = (row.get('fasta_path') or '').strip().replace('\\','/')
             outdir = (row.get('outdir') or '').strip()
             if not outdir:
                 outdir = outdir_for(drug_name, smiles, fasta_path)